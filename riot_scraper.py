@@ -5,16 +5,59 @@ Command-line tool and library to scrape the RiotGames matchlist API.
 from __future__ import print_function, division
 
 import argparse
+import atexit
+import concurrent.futures
 import datetime
+import functools
+import gzip
 import io
 import json
+import mmap
+import operator
 import os
+import re
 import requests
+import requests.adapters
 import riotwatcher
+import riotwatcher.Handlers
 import sys
+import tempfile
+import threading
 import time
-
-json.JSONDecodeError
+import urllib3.util.retry
+import weakref
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+if orjson:
+  _loads = orjson.loads
+  def _dumps_line(obj):
+    return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+else:
+  _loads = json.loads
+  def _dumps_line(obj):
+    return (json.dumps(obj) + '\n').encode('utf8')
+
+# Used to read the fields that the FileStore needs from a line without
+# parsing all of it. Both are top-level integer fields of a match that come
+# before any nested objects in the order returned by the Riot API.
+_GAME_ID_RE = re.compile(rb'"gameId"\s*:\s*(\d+)')
+_GAME_CREATION_RE = re.compile(rb'"gameCreation"\s*:\s*(\d+)')
+
+_get_timestamp = operator.itemgetter('timestamp')
 
 
 class Store(object):
@@ -54,16 +97,38 @@ class Store(object):
 
     raise NotImplementedError
 
+  def close(self):
+    """
+    Called when no more matches will be stored. Implementations should
+    persist any buffered data and release their resources.
+    """
+
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
 
 def scrape(store, api_key, region, summoner_name, empty_weeks_to_stop=10,
-           with_timeline=False, progress_callback=NotImplemented):
+           with_timeline=False, progress_callback=NotImplemented,
+           max_workers=10, cache_dir=None):
   """
   Scrape the matchlist and save all matches in *store*.
 
   progress_callback (function): See #scrape_default_progress_callback().
+  max_workers (int): The number of matches that are downloaded concurrently.
+    Matches are still passed to the *store* one at a time, in order.
+  cache_dir (str): A directory in which downloaded match and timeline
+    information is cached, so that it doesn't have to be requested again
+    when scraping into a new store.
   """
 
   watcher = riotwatcher.RiotWatcher(api_key)
+  session = _make_session(api_key, max_workers + 1)
+  _install_session(watcher, session)
   summoner = watcher.summoner.by_name(region, summoner_name)
 
   if progress_callback is NotImplemented:
@@ -73,65 +138,226 @@ def scrape(store, api_key, region, summoner_name, empty_weeks_to_stop=10,
   # have to find the matches in chunks of one week.
   one_week = 1000 * 3600 * 24 * 7
 
+  has_match = store.has_match
+  store_match = store.store_match
+
+  # Matches returned for more than one time interval are only downloaded
+  # once, even if the store doesn't know about them yet.
+  seen = set()
+  seen_add = seen.add
   user_abort = False
-  for interval in store.suggest_search_intervals(summoner['accountId']):
-    if user_abort: break
-    if interval[1] is None:
-      interval = (interval[0], int(time.time() * 1000))                         # TODO: that region's current time
-    empty_weeks_passed = 0
-    while empty_weeks_passed < empty_weeks_to_stop:
-      begin_time = interval[1] - one_week
-      if interval[0] and begin_time < interval[0]:
-        begin_time = interval[0]
-      try:
-        matches = watcher.match.matchlist_by_account(
-          region, summoner['accountId'], begin_time=begin_time,
-          end_time=interval[1])['matches']
-      except requests.HTTPError as e:
-        if e.response.status_code == 400:  # request too far in the past?
-          break
-        if e.response.status_code == 404:  # no matches found
-          continue
-        raise
-      interval = (interval[0], begin_time)  # shrink the interval
-      if not matches:
-        empty_weeks_passed += 1
-        continue
-      # Sort by newest first, for consistency with lookback order and the
-      # FileStore --continuous option.
-      matches.sort(key=lambda x: -x['timestamp'])
-      matches = [m for m in matches if not store.has_match(m['gameId'], m['timestamp'])]
-      if progress_callback:
-        event_data = {'beginTime': begin_time, 'matchCount': len(matches)}
-        if progress_callback('matchlist', event_data) is False:
-          user_abort = True
-          break
+  with session, concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+    for interval in store.suggest_search_intervals(summoner['accountId']):
+      if user_abort: break
+      if interval[1] is None:
+        interval = (interval[0], int(time.time() * 1000))                       # TODO: that region's current time
       empty_weeks_passed = 0
-      for index, match_info in enumerate(matches):
+      while empty_weeks_passed < empty_weeks_to_stop:
+        begin_time = interval[1] - one_week
+        if interval[0] and begin_time < interval[0]:
+          begin_time = interval[0]
+        try:
+          matches = watcher.match.matchlist_by_account(
+            region, summoner['accountId'], begin_time=begin_time,
+            end_time=interval[1])['matches']
+        except requests.HTTPError as e:
+          if e.response.status_code == 400:  # request too far in the past?
+            break
+          if e.response.status_code == 404:  # no matches found
+            continue
+          raise
+        interval = (interval[0], begin_time)  # shrink the interval
+        if not matches:
+          empty_weeks_passed += 1
+          continue
+        # Sort by newest first, for consistency with lookback order and the
+        # FileStore --continuous option. The Riot API usually returns the
+        # matches in that order already.
+        if not _is_newest_first(matches):
+          matches.sort(key=_get_timestamp, reverse=True)
+        new_matches = []
+        for m in matches:
+          if m['gameId'] not in seen and not has_match(m['gameId'], m['timestamp']):
+            seen_add(m['gameId'])
+            new_matches.append(m)
+        matches = new_matches
         if progress_callback:
-          event_data = {'matchIndex': index, 'matchCount': len(matches)}
-          if progress_callback('match', event_data) is False:
+          event_data = {'beginTime': begin_time, 'matchCount': len(matches)}
+          if progress_callback('matchlist', event_data) is False:
             user_abort = True
             break
-        match_data = watcher.match.by_id(region, match_info['gameId'])
-        timeline = None
-        if with_timeline:
-          try:
-            timeline = watcher.match.timeline_by_match(region, match_info['gameId'])
-          except requests.HTTPError as e:
-            if e.response.status_code != 404:  # no timeline data
-              raise
-            timeline = {}  # indicate that no timeline data is present
-        store.store_match(
-          match_info['gameId'],
-          match_info['timestamp'],
-          match_data,
-          timeline
-        )
+        empty_weeks_passed = 0
+        futures = [executor.submit(_fetch_match, watcher, region,
+                                   m['gameId'], with_timeline, cache_dir)
+                   for m in matches]
+        try:
+          for index, (match_info, future) in enumerate(zip(matches, futures)):
+            if progress_callback:
+              event_data = {'matchIndex': index, 'matchCount': len(matches)}
+              if progress_callback('match', event_data) is False:
+                user_abort = True
+                break
+            match_data, timeline = future.result()
+            store_match(
+              match_info['gameId'],
+              match_info['timestamp'],
+              match_data,
+              timeline
+            )
+        finally:
+          # Don't download matches that we're not going to store.
+          for future in futures:
+            future.cancel()
 
   return not user_abort
 
 
+def _is_newest_first(matches):
+  """
+  Returns #True if the list of *matches* is sorted by descending timestamp.
+  """
+
+  timestamps = list(map(_get_timestamp, matches))
+  return all(a >= b for a, b in zip(timestamps, timestamps[1:]))
+
+
+class _SessionRequestHandler(riotwatcher.Handlers.RequestHandler):
+  """
+  A Riot-Watcher request handler that performs the request using a
+  #requests.Session, so that connections to the Riot API are kept alive and
+  reused. Must be the last handler in the chain.
+  """
+
+  def __init__(self, session):
+    self._session = session
+
+  def preview_request(self, region, endpoint_name, method_name, url, query_params):
+    return self._session.get(url, params=query_params)
+
+
+def _make_session(api_key, pool_size):
+  """
+  Create a #requests.Session for the Riot API that keeps up to *pool_size*
+  connections per host alive and retries requests that failed with a server
+  error. Rate limiting (status code 429) is left to #_call_rate_limited().
+  """
+
+  retry = urllib3.util.retry.Retry(
+    total=5, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504],
+    raise_on_status=False)
+  adapter = requests.adapters.HTTPAdapter(
+    pool_connections=16, pool_maxsize=pool_size, max_retries=retry)
+  session = requests.Session()
+  session.headers['X-Riot-Token'] = api_key
+  session.mount('https://', adapter)
+  return session
+
+
+def _install_session(watcher, session):
+  """
+  Make the #riotwatcher.RiotWatcher *watcher* send its requests through
+  *session*. Riot-Watcher has no public option for this, so we append a
+  #_SessionRequestHandler to its handler chain. Does nothing if the handler
+  chain can not be found, in which case Riot-Watcher uses a new connection
+  for every request.
+  """
+
+  handlers = getattr(getattr(watcher, '_base_api', None), '_request_handlers', None)
+  if isinstance(handlers, list):
+    handlers.append(_SessionRequestHandler(session))
+
+
+def _call_rate_limited(func, *args, **kwargs):
+  """
+  Call *func* and retry if the Riot API responds with status code 429 (rate
+  limit exceeded), waiting as long as the `Retry-After` header asks us to.
+  """
+
+  retries = 0
+  while True:
+    try:
+      return func(*args, **kwargs)
+    except requests.HTTPError as e:
+      if e.response.status_code != 429 or retries >= 5:
+        raise
+      retries += 1
+      time.sleep(float(e.response.headers.get('Retry-After', 2 ** retries)))
+
+
+def _cached(cache_dir, kind, region, match_id, func, *args):
+  """
+  Returns the data of the specified *kind* for *match_id* in *region* from
+  the *cache_dir*. If it is not cached yet, *func* is called with *args* and
+  its result is written to the cache. Match IDs are only unique within a
+  region, so every region has its own subdirectory, in which the cache files
+  are distributed over subdirectories with up to 1000 matches each. If
+  *cache_dir* is #None, *func* is always called.
+  """
+
+  if cache_dir is None:
+    return func(*args)
+  path = os.path.join(cache_dir, region, str(match_id // 1000),
+                      '{}.{}.json'.format(match_id, kind))
+  try:
+    with open(path, 'rb') as fp:
+      return _loads(fp.read())
+  except (IOError, OSError, ValueError):
+    pass
+
+  data = func(*args)
+
+  # Write to a temporary file first, so that a cache file is never read
+  # while it is only partially written.
+  dirname = os.path.dirname(path)
+  if not os.path.isdir(dirname):
+    try:
+      os.makedirs(dirname)
+    except OSError:
+      if not os.path.isdir(dirname):
+        raise
+  fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'wb') as fp:
+      fp.write(_dumps_line(data))
+    os.replace(tmp, path)
+  except BaseException:
+    os.remove(tmp)
+    raise
+  return data
+
+
+def _fetch_timeline(watcher, region, match_id):
+  """
+  Download the timeline for the match identified by *match_id*. Returns an
+  empty dictionary if there is no timeline information for the match.
+  """
+
+  try:
+    return _call_rate_limited(watcher.match.timeline_by_match, region, match_id)
+  except requests.HTTPError as e:
+    if e.response.status_code != 404:  # no timeline data
+      raise
+    return {}  # indicate that no timeline data is present
+
+
+def _fetch_match(watcher, region, match_id, with_timeline, cache_dir=None):
+  """
+  Download the match information and, if *with_timeline* is #True, the
+  timeline for the match identified by *match_id*. Returns a tuple of both.
+  If *cache_dir* is specified, the data is taken from and saved to that
+  directory (see #_cached()). This function is called from worker threads
+  in #scrape().
+  """
+
+  match_data = _cached(cache_dir, 'match', region, match_id,
+                       _call_rate_limited, watcher.match.by_id, region, match_id)
+  timeline = None
+  if with_timeline:
+    timeline = _cached(cache_dir, 'timeline', region, match_id,
+                       _fetch_timeline, watcher, region, match_id)
+  return match_data, timeline
+
+
 def scrape_default_progress_callback(event, data):
   """
   Default progress callback for the #scrape() function.
@@ -154,98 +380,511 @@ def scrape_default_progress_callback(event, data):
     print('  downloading match {}/{}'.format(data['matchIndex']+1, data['matchCount']))
 
 
+def _iter_lines(file):
+  """
+  Yields a tuple for every line of the binary *file*: the line as a bytes
+  object without the line terminator, and #True if the line was terminated
+  (#False for a last line that has no newline after it). The file is
+  memory-mapped if possible so that it does not have to be read into memory
+  as a whole. Otherwise, it is read with a single call and its file position
+  is restored afterwards.
+  """
+
+  try:
+    fileno = file.fileno()
+  except (AttributeError, io.UnsupportedOperation):
+    fileno = None
+
+  if fileno is None:
+    pos = file.tell()
+    file.seek(0)
+    data = file.read()
+    file.seek(pos)
+    lines = data.split(b'\n')
+    last = lines.pop()
+    for line in lines:
+      yield line, True
+    if last:
+      yield last, False
+    return
+
+  size = os.fstat(fileno).st_size
+  if not size:
+    return
+  data = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+  try:
+    find = data.find
+    start = 0
+    while start < size:
+      end = find(b'\n', start)
+      if end < 0:
+        yield data[start:size], False
+        break
+      yield data[start:end], True
+      start = end + 1
+  finally:
+    data.close()
+
+
+def _last_byte(file):
+  """
+  Returns the last byte of the binary *file*, or an empty bytes object if
+  the file is empty. Reads at the exact offset with `os.pread()` if possible,
+  otherwise falls back to seeking (restoring the file position afterwards).
+  """
+
+  try:
+    fileno = file.fileno()
+  except (AttributeError, io.UnsupportedOperation):
+    fileno = None
+  if fileno is not None and hasattr(os, 'pread'):
+    size = os.fstat(fileno).st_size
+    return os.pread(fileno, 1, size - 1) if size else b''
+  pos = file.tell()
+  try:
+    size = file.seek(0, os.SEEK_END)
+    if not size:
+      return b''
+    file.seek(size - 1)
+    return file.read(1)
+  finally:
+    file.seek(pos)
+
+
+class _DirectFile(object):
+  """
+  A write-only file that bypasses the page cache, for use by the #FileStore
+  in *direct* mode. On Linux, the file is opened with `O_DIRECT`, which only
+  allows writing whole blocks at block-aligned offsets from a block-aligned
+  buffer. Written data is therefore collected and copied to a page-aligned
+  buffer until whole blocks can be written; the unaligned head and tail are
+  written with `O_DIRECT` temporarily disabled. On macOS, `F_NOCACHE` is used
+  instead. Elsewhere, or if the file system does not support `O_DIRECT`, this
+  is a plain unbuffered file.
+  """
+
+  block_size = max(4096, mmap.PAGESIZE)
+  buffer_size = 256 * block_size
+
+  def __init__(self, path, append):
+    flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if append else os.O_TRUNC)
+    direct = getattr(os, 'O_DIRECT', 0)
+    fd = None
+    if direct:
+      try:
+        fd = os.open(path, flags | direct, 0o644)
+      except OSError:
+        direct = 0
+    if fd is None:
+      fd = os.open(path, flags, 0o644)
+    if not direct and fcntl and hasattr(fcntl, 'F_NOCACHE'):
+      fcntl.fcntl(fd, fcntl.F_NOCACHE, 1)
+    self._fd = fd
+    self._direct = direct
+    self._direct_enabled = bool(direct)
+    self._offset = os.fstat(fd).st_size
+    self._pending = bytearray()
+    self._buffer = mmap.mmap(-1, self.buffer_size)  # page-aligned memory
+
+  def fileno(self):
+    return self._fd
+
+  def write(self, data):
+    self._pending += data
+    if len(self._pending) >= self.buffer_size:
+      self._drain(False)
+    return len(data)
+
+  def flush(self):
+    self._drain(True)
+
+  def close(self):
+    if self._fd is None:
+      return
+    try:
+      self.flush()
+    finally:
+      os.close(self._fd)
+      self._buffer.close()
+      self._fd = None
+
+  def _drain(self, everything):
+    """
+    Write all whole blocks of pending data with `O_DIRECT`, and the rest as
+    well if *everything* is #True.
+    """
+
+    if not self._direct:
+      # Nothing needs to be aligned, write whatever is pending.
+      everything = True
+    bs = self.block_size
+    view = memoryview(self._pending)
+    pos = 0
+    if self._direct:
+      head = -self._offset % bs
+      if head and len(view) >= head:
+        pos = self._write(view[:head], False)
+      if not head or pos:
+        while len(view) - pos >= bs:
+          n = min(len(view) - pos, self.buffer_size) // bs * bs
+          self._buffer[:n] = view[pos:pos+n]
+          block = memoryview(self._buffer)[:n]
+          try:
+            pos += self._write(block, True)
+          finally:
+            block.release()
+    if everything and pos < len(view):
+      pos += self._write(view[pos:], False)
+    view.release()
+    del self._pending[:pos]
+
+  def _write(self, data, direct):
+    if self._direct and direct != self._direct_enabled:
+      flags = fcntl.fcntl(self._fd, fcntl.F_GETFL)
+      flags = (flags | self._direct) if direct else (flags & ~self._direct)
+      fcntl.fcntl(self._fd, fcntl.F_SETFL, flags)
+      self._direct_enabled = direct
+    written = 0
+    while written < len(data):
+      written += os.write(self._fd, data[written:])
+    self._offset += written
+    return written
+
+
+def _close_at_exit(store_ref):
+  """
+  Registered with #atexit for every #FileStore to close the store if it is
+  still alive when the interpreter exits.
+  """
+
+  store = store_ref()
+  if store is not None:
+    store.close()
+
+
 class FileStore(Store):
   """
-  Store matches in JSONLine formatted file.
+  Store matches in JSONLine formatted file. If *file* is a file object, it
+  must be opened in binary mode.
+
+  The file is only flushed every *flush_every* matches and when the store
+  is closed, so call #close() when you are done or use the store as a
+  context manager. Stores that are not closed explicitly are closed when
+  they are garbage collected or when the interpreter exits.
+
+  If *direct* is #True, matches are written past the operating system's page
+  cache (see #_DirectFile). This requires *file* to be a filename.
+
+  With *append*, the existing matches are read in a background thread, so
+  that the store can be passed to #scrape() right away. Methods that need
+  the existing matches wait for the thread to finish and raise its error,
+  if any.
   """
 
-  def __init__(self, file, append=False, close=True, continuous=False):
+  def __init__(self, file, append=False, close=True, continuous=False,
+               flush_every=1024, direct=False):
+    path = None
     if isinstance(file, str):
-      file = open(file, 'a+' if append else 'w+')
+      path = file
+      file = self._open(path, append, direct)
+    elif direct:
+      raise ValueError('direct=True requires a filename')
     self._file = file
     self._close = close
     self._matches = set()
     self._mintime = None
     self._maxtime = None
-    self._has_newline = True
     self._continuous = continuous
+    self._flush_every = flush_every
+    self._unflushed = 0
 
+    # Bound once for the store_match() hot path.
+    self._write = file.write
+    self._add = self._matches.add
+
+    self._scan = None
+    self._scan_error = None
     if append:
-      pos = file.tell()
-      file.seek(0)
-      for index, line in enumerate(l.strip() for l in file):
-        if not line: continue
+      self._scan = threading.Thread(target=self._scan_existing, args=(path,))
+      self._scan.start()
+
+    # Only keep a weak reference, so that the store can still be garbage
+    # collected (and is closed by __del__) if it is not closed explicitly.
+    self._close_at_exit = functools.partial(_close_at_exit, weakref.ref(self))
+    atexit.register(self._close_at_exit)
+
+  def _open(self, path, append, direct):
+    """
+    Open the file at *path* for writing.
+    """
+
+    if direct:
+      return _DirectFile(path, append)
+    raw = io.FileIO(path, 'a' if append else 'w')
+    return io.BufferedWriter(raw, buffer_size=1 << 20)
+
+  def _encode(self, match_data):
+    """
+    Serialize *match_data* to a record in the file.
+    """
+
+    return _dumps_line(match_data)
+
+  def _scan_existing(self, path):
+    """
+    Target of the background thread that reads the existing matches.
+    """
+
+    try:
+      # Files that we opened ourselves are write-only, read the existing
+      # matches through a separate file object.
+      if path is not None:
+        with open(path, 'rb') as reader:
+          self._read_existing(reader)
+      else:
+        self._read_existing(self._file)
+    except BaseException as e:
+      self._scan_error = e
+
+  def _wait_for_scan(self):
+    """
+    Wait for the background thread that reads the existing matches to
+    finish. Raises the error that occurred in the thread, if any.
+    """
+
+    if self._scan is not None:
+      self._scan.join()
+      if self._scan_error is not None:
+        raise self._scan_error
+      self._scan = None
+
+  def _read_existing(self, file):
+    """
+    Read the matches from the binary *file* that the store appends to, and
+    make sure that the next match will be written on a new line.
+    """
+
+    ids = []
+    creation_times = []
+    add_id = ids.append
+    add_time = creation_times.append
+    search_id = _GAME_ID_RE.search
+    search_created = _GAME_CREATION_RE.search
+    for index, (line, terminated) in enumerate(_iter_lines(file)):
+      if not line or line.isspace(): continue
+      # Only trust the regular expressions for lines that were completely
+      # written. A last line without a newline may have been cut off by a
+      # crash and must fail to parse below.
+      game_id = created = None
+      if terminated:
+        game_id = search_id(line)
+        created = search_created(line)
+      if game_id and created:
+        game_id = int(game_id.group(1))
+        created = int(created.group(1))
+      else:
         try:
-          match = json.loads(line)
-        except json.JSONDecodeError as e:
+          match = _loads(line)
+        except ValueError as e:
           raise ValueError('invalid JSON at line {}: {}'.format(index+1, e))
-        if self._mintime is None or match['gameCreation'] < self._mintime:
-          self._mintime = match['gameCreation']
-        if self._maxtime is None or match['gameCreation'] > self._maxtime:
-          self._maxtime = match['gameCreation']
-        self._matches.add(match['gameId'])
-
-      # Check if the file has a newline at the end.
-      file.seek(0, os.SEEK_END)
-      file.seek(file.tell() - 1)
-      if file.read(1) != '\n':
-        self._has_newline = False
-      file.seek(pos)
+        game_id = match['gameId']
+        created = match['gameCreation']
+      add_id(game_id)
+      add_time(created)
+    self._add_existing(ids, creation_times)
+
+    # Make sure that the first match we append starts on a new line.
+    if _last_byte(file) not in (b'', b'\n'):
+      self._file.write(b'\n')
+
+  def _add_existing(self, ids, creation_times):
+    """
+    Record the IDs and creation times of the matches read from the file.
+    """
+
+    self._matches.update(ids)
+    if creation_times:
+      self._mintime = min(creation_times)
+      self._maxtime = max(creation_times)
 
   def suggest_search_intervals(self, account_id):
+    self._wait_for_scan()
     if self._continuous and self._matches:
       return [(None, self._mintime), (self._maxtime, None)]
     return [(None, None)]
 
   def has_match(self, match_id, timestamp):
+    if self._scan is not None:
+      self._wait_for_scan()
     return match_id in self._matches
 
   def store_match(self, match_id, timestamp, match_data, timeline):
-    if not self._has_newline:
-      self._file.write('\n')
-      self._has_newline = True
+    if self._scan is not None:
+      self._wait_for_scan()
     match_data['timeline'] = timeline
-    self._file.write(json.dumps(match_data))
-    self._file.write('\n')
+    self._write(self._encode(match_data))
+    self._add(match_id)
+    self._unflushed += 1
+    if self._unflushed >= self._flush_every:
+      self.flush()
+
+  def flush(self):
+    """
+    Flush matches that are still buffered to the file.
+    """
+
+    self._wait_for_scan()
     self._file.flush()
-    self._matches.add(match_id)
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument('api_key')
-parser.add_argument('summoner',
-  help='In the form of <region>:<summoner_name>')
-parser.add_argument('--with-timeline', action='store_true',
-  help='Retrieve timeline information for every match (if available).')
-parser.add_argument('--output',
-  help='Output filename. Defaults to <summoner_name>.jsonl')
-parser.add_argument('--append', action='store_true',
-  help='Recognize existing matches in the output file and append new entries.')
-parser.add_argument('--cont', '--continuous', action='store_true',
-  help='Assume that matches in the output file are continuous. This is '
-       'enabled by default if --output is not specified, because it assumes '
-       'that only matches for a specific summoner are being downloaded.')
-parser.add_argument('--discont', '--discontinuous', action='store_true',
-  help='The opposite of --cont, --continuous. Use this flag to disable the '
-       'default --continuous flag when no --output is specified.')
+    self._unflushed = 0
+
+  def close(self):
+    if self._file is None:
+      return
+    atexit.unregister(self._close_at_exit)
+    try:
+      if self._scan is not None:
+        self._scan.join()
+      if self._scan_error is None:
+        self.flush()
+    finally:
+      if self._close:
+        self._file.close()
+      self._file = None
+
+  def __del__(self):
+    if getattr(self, '_close_at_exit', None) and self._file is not None:
+      self.close()
+
+
+class BinaryFileStore(FileStore):
+  """
+  Store matches in a file as a stream of MessagePack objects, which is
+  faster to write and read and smaller than JSONLines. Requires the
+  `msgpack` module. If *compress* is #True, the file is gzip compressed,
+  which requires *file* to be a filename. See #FileStore for the other
+  parameters.
+  """
+
+  def __init__(self, file, append=False, close=True, continuous=False,
+               flush_every=1024, direct=False, compress=False):
+    if msgpack is None:
+      raise RuntimeError('BinaryFileStore requires the msgpack module')
+    if compress and not isinstance(file, str):
+      raise ValueError('compress=True requires a filename')
+    if compress and direct:
+      raise ValueError('compress=True and direct=True are incompatible')
+    self._compress = compress
+    super(BinaryFileStore, self).__init__(file, append, close, continuous,
+                                          flush_every, direct)
+
+  def _open(self, path, append, direct):
+    if self._compress:
+      return gzip.open(path, 'ab' if append else 'wb')
+    return super(BinaryFileStore, self)._open(path, append, direct)
+
+  def _encode(self, match_data):
+    return msgpack.packb(match_data)
+
+  def _read_existing(self, file):
+    # Always read from the start of the file, a file object opened in
+    # append mode is positioned at the end.
+    pos = file.tell()
+    file.seek(0)
+    try:
+      self._read_stream(gzip.GzipFile(fileobj=file, mode='rb')
+                        if self._compress else file)
+    finally:
+      file.seek(pos)
+
+  def _read_stream(self, stream):
+    """
+    Read the matches from the uncompressed *stream*, starting at offset 0.
+    """
+
+    ids = []
+    creation_times = []
+    unpacker = msgpack.Unpacker(stream, raw=False)
+    try:
+      for match in unpacker:
+        ids.append(match['gameId'])
+        creation_times.append(match['gameCreation'])
+    except ValueError as e:
+      raise ValueError('invalid MessagePack data after {} matches: {}'.format(
+        len(ids), e))
+    except EOFError:  # truncated gzip member
+      raise ValueError('truncated MessagePack data after {} matches'.format(
+        len(ids)))
+    # The Unpacker silently stops at a partial record at the end of the
+    # file. New records must not be appended after it.
+    if unpacker.tell() != stream.tell():
+      raise ValueError('truncated MessagePack data after {} matches'.format(
+        len(ids)))
+    self._add_existing(ids, creation_times)
+
 
 def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('api_key')
+  parser.add_argument('summoner',
+    help='In the form of <region>:<summoner_name>')
+  parser.add_argument('--with-timeline', action='store_true',
+    help='Retrieve timeline information for every match (if available).')
+  parser.add_argument('--output',
+    help='Output filename. Defaults to <summoner_name>.jsonl, or '
+         '<summoner_name>.msgpack with --binary.')
+  parser.add_argument('--append', action='store_true',
+    help='Recognize existing matches in the output file and append new entries.')
+  parser.add_argument('--cont', '--continuous', action='store_true',
+    help='Assume that matches in the output file are continuous. This is '
+         'enabled by default if --output is not specified, because it assumes '
+         'that only matches for a specific summoner are being downloaded.')
+  parser.add_argument('--discont', '--discontinuous', action='store_true',
+    help='The opposite of --cont, --continuous. Use this flag to disable the '
+         'default --continuous flag when no --output is specified.')
+  parser.add_argument('--cache-dir',
+    help='Cache downloaded matches in this directory and take them from there '
+         'instead of requesting them again.')
+  parser.add_argument('--direct', action='store_true',
+    help='Write the output file past the operating system\'s page cache.')
+  parser.add_argument('--binary', action='store_true',
+    help='Write matches in MessagePack format instead of JSONLines. Requires '
+         'the msgpack module.')
+  parser.add_argument('--compress', action='store_true',
+    help='Gzip compress the output file. Requires --binary.')
+
   args = parser.parse_args()
   if not args.output and args.append and not args.discont:
     print('assuming existing data is continuous.')
     args.cont = True
-  region, summoner_name = args.summoner.partition(':')[::2]
+  parts = args.summoner.split(':', 1)
+  region, summoner_name = parts if len(parts) == 2 else ('', '')
   if not region or not summoner_name:
     print('error: second positional argument must be of the format ')
     print('       <region>:<summoner_name>, got "{}"'.format(args.summoner))
     return 1
+  if args.compress and not args.binary:
+    print('error: --compress requires --binary')
+    return 1
+  if args.compress and args.direct:
+    print('error: --compress can not be combined with --direct')
+    return 1
   if not args.output:
-    args.output = summoner_name + '.jsonl'
+    args.output = summoner_name + ('.msgpack' if args.binary else '.jsonl')
+    if args.compress:
+      args.output += '.gz'
   if args.append:
     print('reading existing data...')
-  store = FileStore(args.output, append=args.append, continuous=args.cont)
-  scrape(store, args.api_key, region, summoner_name,
-    with_timeline=args.with_timeline)
+  if args.binary:
+    store = BinaryFileStore(args.output, append=args.append,
+      continuous=args.cont, direct=args.direct, compress=args.compress)
+  else:
+    store = FileStore(args.output, append=args.append, continuous=args.cont,
+      direct=args.direct)
+  try:
+    scrape(store, args.api_key, region, summoner_name,
+      with_timeline=args.with_timeline, cache_dir=args.cache_dir)
+  finally:
+    store.close()
 
 
 if __name__ == '__main__':